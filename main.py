@@ -1,22 +1,36 @@
 # Downloads course content from brightspace and saves to disk
 import argparse
 import datetime
+import functools
+import gzip
+import io
 import json
 import logging
 import os
 import pathlib
 import sys
+import queue
 import re
+import shutil
+import tempfile
+import threading
 import zipfile
-from time import sleep
-from typing import Union, Optional, Dict, List
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import unquote
+from time import monotonic, sleep, time
+from typing import Union, Optional, Dict, List, Tuple
 
+import lxml.html
 import requests
-from bs4 import BeautifulSoup
 from dotenv import load_dotenv
+from requests.adapters import HTTPAdapter
 from selenium import webdriver
-from selenium.common.exceptions import NoAlertPresentException, NoSuchElementException, StaleElementReferenceException
+from selenium.common.exceptions import NoAlertPresentException, NoSuchElementException, TimeoutException
+from selenium.webdriver.common.by import By
+from selenium.webdriver.common.desired_capabilities import DesiredCapabilities
 from selenium.webdriver.firefox.options import Options
+from selenium.webdriver.support import expected_conditions as EC
+from selenium.webdriver.support.ui import WebDriverWait
 
 # Set up logging
 logging.basicConfig(level=logging.DEBUG, filename='downloads.log', filemode='w',
@@ -27,6 +41,10 @@ logging.getLogger().addHandler(logging.StreamHandler())
 load_dotenv()
 LOGIN_URL = "https://emlyon.brightspace.com/"
 BASE_URL = "https://emlyon.brightspace.com/d2l/le/content/"
+API_URL = "https://emlyon.brightspace.com/d2l/api/le/1.67/"  # Brightspace learning environment API
+# Bootcamp files have yotta in link, datasets are stored as zip and on external links. Yotta is matched first
+LINK_TYPES = re.compile(r"(?P<yotta>.*yotta)|(?P<dataset>.*\.zip)")
+COOKIE_URL = f"{LOGIN_URL}robots.txt"  # Page on the brightspace domain that doesn't redirect to log in
 save_folder = pathlib.Path.home() / "Documents/Em-lyon/brightspace"  # Save to user Documents folder
 user = os.getenv("USER_NAME")
 password = os.getenv("PASSWORD")
@@ -35,6 +53,10 @@ bootcamp_url = os.getenv("BOOTCAMP_URL")
 bootcamp_user = os.getenv("BOOTCAMP_USER")
 bootcamp_pass = os.getenv("BOOTCAMP_PASS")
 
+# Seconds to wait for page elements and for the download button of a unit to show up
+WAIT_TIMEOUT = 15
+DOWNLOAD_BUTTON_TIMEOUT = 5
+
 # Add argument for setting directory to download content to
 my_parser = argparse.ArgumentParser(description='Download course contents from brightspace')
 
@@ -43,22 +65,78 @@ my_parser.add_argument("-d",
                        metavar="arg_directory",
                        type=str,
                        help="name of text arg_file to search")
+my_parser.add_argument("-w",
+                       "--workers",
+                       metavar="arg_workers",
+                       type=int,
+                       default=4,
+                       help="number of Firefox sessions to download courses with in parallel")
 
 args = my_parser.parse_args()
 if args.directory:
-    save_folder = pathlib.Path(args.directory)
+    save_folder = pathlib.Path(args.directory).resolve()
 logging.info(f"Saving files to {save_folder}")
+# Each Firefox session downloads to its own folder so parallel downloads don't get mixed up
+download_root = save_folder / ".downloads"
+# Units downloaded in earlier runs are kept in a manifest so they can be skipped
+manifest_file = save_folder / ".download_manifest.json"
+
+# Zip downloads smaller than this are extracted from memory without saving the zip first
+IN_MEMORY_ZIP_SIZE = 50 * 1024 * 1024
+# Number of zip downloads that may be held in memory at the same time
+in_memory_zips = threading.BoundedSemaphore(2)
+
+# Shared session so bootcamp and content API downloads reuse pooled keep-alive connections
+SESSION = requests.Session()
+SESSION.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=20))
 
 # Set download preferences for Firefox to make it download automatically with no dialogue
 op = Options()
 op.set_preference("browser.download.folderList", 2)
 op.set_preference("browser.download.manager.showWhenStarting", False)
-op.set_preference("browser.download.dir", str(save_folder))
-op.set_preference("browser.helperApps.neverAsk.saveToDisk", "application/x-zip-compressed")
-op.set_preference("browser.helperApps.neverAsk.saveToDisk", "application/zip")
+op.set_preference("browser.download.useDownloadDir", True)
+# Setting the preference again overwrites it, so all MIME types go in one comma separated list
+op.set_preference("browser.helperApps.neverAsk.saveToDisk",
+                  "application/zip,application/x-zip-compressed,application/octet-stream,"
+                  "application/x-7z-compressed,application/x-rar-compressed")
+op.set_preference("pdfjs.disabled", True)  # Save pdfs instead of opening them in the pdf viewer
+# Don't load images, web fonts or media as only the page structure is used
+op.set_preference("permissions.default.image", 2)
+op.set_preference("browser.display.use_document_fonts", 0)
+op.set_preference("media.autoplay.default", 5)
+op.set_preference("network.http.max-persistent-connections-per-server", 10)
+# Keep memory flat across courses by not caching pages to disk or keeping previous pages in memory
+op.set_preference("browser.cache.disk.enable", False)
+op.set_preference("browser.sessionhistory.max_total_viewers", 0)
 op.headless = True
+# Return from driver.get once the DOM is ready instead of waiting for every resource, explicit waits handle the rest
+capabilities = DesiredCapabilities.FIREFOX.copy()
+capabilities["pageLoadStrategy"] = "eager"
 
-driver = webdriver.Firefox(options=op)
+# Pool of (driver, download folder) pairs shared by the course download workers
+driver_pool = queue.Queue()
+# Downloaded units by "course name/unit name", shared by the workers
+manifest = {}
+manifest_lock = threading.Lock()
+
+
+def make_driver(download_dir: pathlib.Path, cookies: Optional[List[Dict]] = None) -> webdriver.Firefox:
+    """
+    Creates a headless Firefox driver that saves downloads to the given folder
+    :param download_dir: Folder Firefox saves downloaded files to
+    :param cookies: Optional cookies from a logged in driver to reuse the session instead of logging in again
+    :return: Firefox webdriver
+    """
+    create_base_folder(download_dir)
+    op.set_preference("browser.download.dir", str(download_dir))
+    driver = webdriver.Firefox(options=op, desired_capabilities=capabilities)
+    driver.implicitly_wait(0)  # Only use explicit waits so timeouts don't add up
+    if cookies:
+        # Cookies can only be added for the domain of the page that is open
+        driver.get(COOKIE_URL)
+        for cookie in cookies:
+            driver.add_cookie(cookie)
+    return driver
 
 
 def open_course_list(filename: str = "courses.json") -> Union[dict]:
@@ -80,10 +158,40 @@ def open_course_list(filename: str = "courses.json") -> Union[dict]:
     return courses
 
 
-def check_if_alert() -> Optional[bool]:
+def load_manifest(filename: Union[str, pathlib.Path] = manifest_file) -> Dict[str, dict]:
+    """
+    Loads the manifest of units downloaded in earlier runs
+    :param filename: Name of the manifest json file
+    :return: Dict of "course name/unit name" keys with "completed" and "mtime", empty if there is no manifest
+    """
+    try:
+        with open(filename) as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+
+def mark_downloaded(key: str, filename: Union[str, pathlib.Path] = manifest_file) -> None:
+    """
+    Marks a unit as downloaded in the manifest and saves it. The manifest is written to a temporary file first and
+    then replaces the old one so an interrupted run can't leave a broken manifest
+    :param key: "course name/unit name" of the unit
+    :param filename: Name of the manifest json file
+    :return: None
+    """
+    with manifest_lock:
+        manifest[key] = {"completed": True, "mtime": time()}
+        fd, tmp_name = tempfile.mkstemp(dir=pathlib.Path(filename).parent, suffix=".tmp")
+        with os.fdopen(fd, "w") as f:
+            json.dump(manifest, f, indent=2)
+        os.replace(tmp_name, filename)
+
+
+def check_if_alert(driver: webdriver.Firefox) -> Optional[bool]:
     """
     Checks if javascript log in alert is present and waits for user to enter user and password manually
     and presses enter key to continue
+    :param driver: Firefox webdriver to check for alert
     :return: True if alert is present None otherwise
     """
     try:
@@ -94,9 +202,10 @@ def check_if_alert() -> Optional[bool]:
         return
 
 
-def log_in(user: str = user, password: str = password) -> None:
+def log_in(driver: webdriver.Firefox, user: str = user, password: str = password) -> None:
     """
     Logs in to brightspace with given username and password
+    :param driver: Firefox webdriver to log in with
     :param user: Brightspace username
     :param password: Brightspace password
     """
@@ -106,198 +215,471 @@ def log_in(user: str = user, password: str = password) -> None:
 
     driver.get(LOGIN_URL)
     # Handle cases where on local emlyon network and an alert login pop up displays
-    if not check_if_alert():
-        # Select html xpath for username, password and sign in button
-        user_xpath = '//*[@id="userNameInput"]'
-        # Find username, pasword and sign in elements and send keys for log in
-        user_element = driver.find_element_by_xpath(user_xpath)
-        password_xpath = '//*[@id="passwordInput"]'
-        password_element = driver.find_element_by_xpath(password_xpath)
-        sign_in_button = '//*[@id="submitButton"]'
-
-        sign_in = driver.find_element_by_xpath(sign_in_button)
+    if not check_if_alert(driver):
+        # Find username, pasword and sign in elements by id and send keys for log in
+        user_element = driver.find_element(By.ID, "userNameInput")
+        password_element = driver.find_element(By.ID, "passwordInput")
+        sign_in = driver.find_element(By.ID, "submitButton")
         user_element.send_keys(user)
         password_element.send_keys(password)
         sign_in.click()
 
 
+def get_session_cookies(driver: webdriver.Firefox) -> List[Dict]:
+    """
+    Waits for the log in redirects to get back to brightspace and returns the session cookies
+    :param driver: Firefox webdriver that has logged in
+    :return: List of cookies, empty if the log in did not finish in time
+    """
+    try:
+        WebDriverWait(driver, WAIT_TIMEOUT).until(EC.url_contains(f"{LOGIN_URL}d2l/"))
+    except TimeoutException:
+        logging.warning("Log in did not get back to brightspace, logging in each driver instead")
+        return []
+    return driver.get_cookies()
+
+
 def create_base_folder(folder=save_folder):
-    # Make sure download folder exists and is set
-    pathlib.Path(folder).mkdir(parents=True, exist_ok=True)
-    os.chdir(folder)
+    # Make sure download folder exists
+    _ensure_folder(str(folder))
 
 
-def get_docs_from_non_xframe(course_name):
+@functools.lru_cache(maxsize=None)
+def _ensure_folder(folder: str) -> None:
+    # Folders are created once per run, later calls for the same folder are answered from the cache
+    os.makedirs(folder, exist_ok=True)
+
+
+def get_docs_from_non_xframe(driver: webdriver.Firefox, course_name: str, download_dir: pathlib.Path) -> None:
     """
     Gets course content from courses that do not use iframes
+    :param driver: Firefox webdriver with the course content page open
+    :param course_name: Name of course
+    :param download_dir: Folder the driver saves downloads to
     :return: None
     """
     ignore_content = ["Table of Contents"]  # Elements to not download by name
-    driver.implicitly_wait(2)
-    units = driver.find_elements_by_xpath("//html/body/div[3]/div/div[1]/div[2]/div[1]/div/ul[2]/li")
-    # Filter units to drop ignored
-    units_filtered = filter(lambda x: re.sub(r'[^A-Za-z ]+', '', x.text) not in ignore_content, units)
+    units_locator = (By.XPATH, "//html/body/div[3]/div/div[1]/div[2]/div[1]/div/ul[2]/li")
+    try:
+        WebDriverWait(driver, WAIT_TIMEOUT).until(EC.presence_of_all_elements_located(units_locator))
+    except TimeoutException:
+        logging.debug(f"No units found for {course_name}")
+        return
 
     # Download all non_ignored units using dl_units passing xpath for units
-    dl_units(course_name, units_filtered, {'find_element_by_xpath': '//button[text()="Download"]'})
+    dl_units(driver, course_name, units_locator, (By.XPATH, '//button[text()="Download"]'), download_dir,
+             ignore_content=ignore_content)
+
+
+def get_docs_from_api(course_code: str, course_name: str) -> bool:
+    """
+    Gets course documents through the brightspace content API with the logged in SESSION instead of clicking through
+    the content page. Every top level module is saved to a unit folder within the course name folder.
+    :param course_code: Code of course
+    :param course_name: Name of course
+    :return: True if course content was read from the API, False if the browser has to be used instead
+    """
+    try:
+        r = SESSION.get(f"{API_URL}{course_code}/content/toc", allow_redirects=False)
+    except requests.RequestException as e:
+        logging.debug(f"Could not reach content API for {course_name}: {e}")
+        return False
+    if r.status_code != 200:
+        logging.debug(f"Content API returned {r.status_code} for {course_name}")
+        return False
+    try:
+        modules = r.json()["Modules"]
+    except (ValueError, KeyError):
+        logging.debug(f"Content API did not return a table of contents for {course_name}")
+        return False
+
+    course_dir = save_folder / course_name
+    for module in modules:
+        unit_name = module["Title"].replace("/", "-")
+        manifest_key = f"{course_name}/{unit_name}"
+        if manifest.get(manifest_key, {}).get("completed"):
+            logging.debug(f"Skipping {unit_name}, already downloaded")
+            continue
+
+        # Collect files in the module and its sub modules with the folder to save them to
+        downloads = []
+        paths = set()
+        pending = [(module, course_dir / unit_name)]
+        while pending:
+            current, folder = pending.pop()
+            create_base_folder(folder)
+            for topic in current["Topics"]:
+                if topic["TypeIdentifier"] == "File":
+                    file_name = pathlib.PurePosixPath(unquote(topic["Url"])).name
+                    # Files with the same name in a folder would be written to the same path at the same time,
+                    # so the topic id is added to every name after the first
+                    if (folder, file_name) in paths:
+                        path = pathlib.PurePosixPath(file_name)
+                        file_name = f"{path.stem} ({topic['TopicId']}){path.suffix}"
+                    paths.add((folder, file_name))
+                    downloads.append((f"{API_URL}{course_code}/content/topics/{topic['TopicId']}/file", folder,
+                                      file_name))
+            pending.extend((sub_module, folder / sub_module["Title"].replace("/", "-"))
+                           for sub_module in current["Modules"])
+
+        logging.debug(f"Downloading {unit_name}")
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            downloaded = list(executor.map(download_topic, downloads))
+        # Only mark the unit when every file arrived so failed files are tried again on the next run
+        if all(downloaded):
+            mark_downloaded(manifest_key)
+    return True
 
 
-def get_docs_from_course(url: str, course_name: str) -> None:
+def download_topic(download: Tuple[str, pathlib.Path, str]) -> bool:
+    """
+    Downloads a file topic from the brightspace content API. Failed downloads are logged and skipped so one
+    restricted or missing file doesn't stop the rest of the course
+    :param download: Tuple of topic file url, folder to save to and file name
+    :return: True if the file was downloaded, False otherwise
+    """
+    url, folder, file_name = download
+    try:
+        request_download(SESSION, url, folder, file_name=file_name)
+    except (requests.RequestException, OSError) as e:
+        logging.warning(f"Could not download {file_name} to {folder}: {e}")
+        return False
+    return True
+
+
+def get_docs_from_course(driver: webdriver.Firefox, url: str, course_name: str, download_dir: pathlib.Path) -> None:
     """
     Gets course documents from brightspace learning platform and saves them to a course unit folder within
     the course name folder.
+    :param driver: Firefox webdriver to get course content with
     :param url: Url of course content
     :param course_name: Name of course
+    :param download_dir: Folder the driver saves downloads to
     """
     create_base_folder()
 
     # Open and navigate to course content page
     driver.get(url)
-    driver.implicitly_wait(5)
-    # Page has iframe for contents. Select and switch to iframe
-    frame_xpath = driver.find_elements_by_xpath('//iframe')
+    wait = WebDriverWait(driver, WAIT_TIMEOUT)
+    # Page has iframe for contents. Wait for it and switch to it
     try:
-        driver.switch_to.frame(frame_xpath[0])
-        driver.implicitly_wait(10)
-    except IndexError:
-        get_docs_from_non_xframe(course_name)
+        wait.until(EC.frame_to_be_available_and_switch_to_it((By.TAG_NAME, "iframe")))
+    except TimeoutException:
+        get_docs_from_non_xframe(driver, course_name, download_dir)
+        return
 
-    # Content is divided into units. Get all units using class name
-    all_units = driver.find_elements_by_class_name("unit")
-    # Make sure units exist so only courses with content have folders created
-    if all_units:
-        # Create course folder and switch to it
-        dl_units(course_name, all_units, {"find_element_by_class_name": "download-content-button"})
+    # Content is divided into units. Wait for units using class name
+    units_locator = (By.CLASS_NAME, "unit")
+    try:
+        wait.until(EC.presence_of_all_elements_located(units_locator))
+    except TimeoutException:
+        # Make sure units exist so only courses with content have folders created
+        return
+    dl_units(driver, course_name, units_locator, (By.CLASS_NAME, "download-content-button"), download_dir)
 
 
-def dl_units(course_name: str, units: Union[object], dl_element: Dict[str, str]):
+def dl_units(driver: webdriver.Firefox, course_name: str, units_locator: Tuple[str, str],
+             dl_element: Tuple[str, str], download_dir: pathlib.Path, ignore_content: List[str] = []):
     """
     Downloads units from a brightspace content page
+    :param driver: Firefox webdriver with the course content page open
     :param course_name: Name of course
-    :param units: An interable of units from course content to download
-    :param dl_element: Dict with selenium find_by method and element to find:
-            Ex {""find_element_by_class_name": "download-content-button""}
+    :param units_locator: Selenium locator for the units to download:
+            Ex (By.CLASS_NAME, "unit")
+    :param dl_element: Selenium locator for the download button:
+            Ex (By.CLASS_NAME, "download-content-button")
+    :param download_dir: Folder the driver saves downloads to
+    :param ignore_content: Names of units to not download
     :return: None
     """
-    pathlib.Path(course_name).mkdir(parents=True, exist_ok=True)
-    os.chdir(course_name)
+    course_dir = save_folder / course_name
+    create_base_folder(course_dir)
+
+    # Read all unit texts up front in one script call, as every .text read is a separate round trip to the browser
+    units = driver.find_elements(*units_locator)
+    unit_texts = driver.execute_script("return arguments[0].map(unit => unit.innerText.trim())", units)
 
     # Loop over all units on the content iframe and click download button and save
-    for unit in units:
-        # unit_name = unit.text.split("\n")[0]
-        unit_name = unit.text.split("\n")[0]
-        target_path = pathlib.Path(course_name) / pathlib.Path(unit_name)
-
-        pathlib.Path(unit_name).mkdir(parents=True, exist_ok=True)
-        unit.click()
-        driver.implicitly_wait(2)  # Wait to make sure unit is loaded before clicking download
+    for index, unit_text in enumerate(unit_texts):
+        # Filter units to drop ignored
+        if re.sub(r'[^A-Za-z ]+', '', unit_text) in ignore_content:
+            continue
+        unit_name = unit_text.split("\n")[0]
+        target_path = course_dir / unit_name
+        manifest_key = f"{course_name}/{unit_name}"
+        if manifest.get(manifest_key, {}).get("completed"):
+            logging.debug(f"Skipping {unit_name}, already downloaded")
+            continue
+
+        # Clicking a unit re-renders the page, so find the unit by index every time instead of keeping
+        # elements that would go stale
+        units = driver.find_elements(*units_locator)
+        if index >= len(units):
+            logging.warning(f"Unit {unit_name} is no longer on the page")
+            break
+        create_base_folder(target_path)
+        units[index].click()
         logging.debug(f"Downloading {unit_name}")
-        element_method = list(dl_element.keys())[0]
-        element_name = list(dl_element.values())[0]
+        completed = False
+        # Remove files that were left in the download folder by earlier units before downloading so they can't be
+        # moved into this unit's folder. Files that are still being downloaded are kept and skipped when moving
+        for name in os.listdir(download_dir):
+            leftover = download_dir / name
+            if not name.endswith(".part") and leftover.is_file():
+                leftover.unlink()
+        existing = set(os.listdir(download_dir))
         try:
-            download_btn = getattr(driver, element_method)(element_name)
-            sleep(3)
+            # Wait to make sure unit is loaded before clicking download
+            download_btn = WebDriverWait(driver, DOWNLOAD_BUTTON_TIMEOUT).until(
+                EC.element_to_be_clickable(dl_element))
             download_btn.click()
-            sleep(45)
-        except StaleElementReferenceException as e:
-            download_btn = getattr(driver, element_method)(element_name)
-            download_btn.click()
-            sleep(45)
-        except NoSuchElementException as e:
-            if driver.find_element_by_tag_name("body").text:
-                save_html_page(save_folder.joinpath(unit_name + ".html"), driver.page_source)
+            completed = wait_for_download(download_dir, existing)
+            if not completed:
+                logging.warning(f"Timed out waiting for download of {unit_name}")
+        except (NoSuchElementException, TimeoutException) as e:
+            # Keep a copy of the page but don't mark the unit so a download button that was only slow to load is
+            # tried again on the next run
+            if driver.find_element(By.TAG_NAME, "body").text:
+                save_html_page(download_dir.joinpath(unit_name + ".html"), driver.page_source)
             else:
                 logging.error(e)
                 continue
         finally:
             # logging.debug("%s downloaded", unit_name)
             logging.debug(f"Finished processing {unit_name}")
-            move_and_extract_files(target_path, zip_file_names=[course_name])
+            move_and_extract_files(target_path, source_folder=download_dir, zip_file_names=[course_name],
+                                   skip_names=existing)
             clean_up_files(target_path)
+            if completed:
+                mark_downloaded(manifest_key)
 
 
-def move_and_extract_files(destination_folder, source_folder=save_folder, zip_file_names=[],
-                           extensions=[".zip", ".html", ".part"]) -> None:
+def wait_for_download(folder: Union[str, pathlib.Path], existing: set, timeout: int = 120,
+                      interval: float = 0.1) -> bool:
+    """
+    Waits until a new zip file appears in a folder and Firefox has finished writing it. Firefox keeps a .part file
+    next to the download until it is complete, so the download is done once a new zip exists without its .part file.
+    :param folder: Folder downloads are saved to
+    :param existing: Set of file names in folder before the download was started
+    :param timeout: Maximum number of seconds to wait
+    :param interval: Seconds between each check of the folder
+    :return: True if the download finished before timeout, False otherwise
+    """
+    deadline = monotonic() + timeout
+    while monotonic() < deadline:
+        # Read the folder once per check and look for new zips without their own .part file in the listing.
+        # Leftover .part files from earlier downloads are ignored
+        with os.scandir(folder) as entries:
+            names = {entry.name for entry in entries}
+        new_zips = [name for name in names if name.endswith(".zip") and name not in existing]
+        if any(f"{name}.part" not in names for name in new_zips):
+            return True
+        sleep(interval)
+    return False
+
+
+def move_and_extract_files(destination_folder, source_folder=None, zip_file_names=[],
+                           extensions=[".zip", ".html", ".html.gz", ".part"], skip_names=()) -> None:
     """
     Moves and extracts files with a given extension from source folder to destination folder
     :param zip_file_names: An optional list of file names to limit extraction to
     :param destination_folder: Folder to move files to
-    :param source_folder: Folder to move files from
+    :param source_folder: Folder to move files from, defaults to save_folder
     :param extensions: Extension of files to move
+    :param skip_names: Optional collection of file names in source folder to leave where they are
     """
-    files_to_folder = ["ipynb", "csv", "txt", "py"]  # Filetypes to extract to separate folders
-    # Create set of files to loop over if suffix corresponds to extensions param
-    files = {p.resolve() for p in pathlib.Path(source_folder).glob("*") if
-             p.suffix in extensions}
-
-    # Check if file.name is in zip_file_names to extract to avoid extracting leftover files to wrong folder
-    if zip_file_names is not None:
-        filtered_files = [file for file in files for name in zip_file_names if name in file.name]
+    if source_folder is None:
+        source_folder = save_folder
+    # Create list of files to loop over if suffix corresponds to extensions param. scandir gets the file type
+    # from the directory listing so no extra stat call is made per file
+    with os.scandir(source_folder) as entries:
+        files = [pathlib.Path(entry.path) for entry in entries
+                 if entry.is_file(follow_symlinks=False) and entry.name.endswith(tuple(extensions))
+                 and entry.name not in skip_names]
+
+    # Check if file.name is in zip_file_names to extract to avoid extracting leftover files to wrong folder.
+    # All names are matched with one compiled pattern so each file is checked once
+    filtered_files = []
+    if zip_file_names:
+        name_pattern = re.compile("|".join(map(re.escape, zip_file_names)))
+        filtered_files = [file for file in files if name_pattern.search(file.name)]
 
     # Loop over either filtered files if param set or over files and extract to target folder
+    target_path = pathlib.Path(source_folder) / destination_folder
     for file in filtered_files or files:
-        target_path = file.parent / destination_folder
-        new_path = file.rename(target_path / re.sub(r'\d{1,2}(\d{1,2})?\s(am|pm)?', "", file.name, flags=re.IGNORECASE))
+        new_path = file.rename(target_path / remove_time_from_name(file.name))
         if new_path.suffix == ".zip":
             logging.debug(f"Extracting {file} form {target_path} to {new_path}")
             print(f"Extracting {file} form {target_path} to {new_path}")
 
-            zip_ref = zipfile.ZipFile(new_path)
-            zip_names = zip_ref.namelist()
-            if len(zip_names) > 15:  # Don't extract zip files with too many items
+            # Check the zip headers first so partial or corrupt downloads are removed instead of failing the course
+            if not zipfile.is_zipfile(new_path):
+                logging.warning(f"Not a zip file, removing {new_path}")
+                new_path.unlink()
                 continue
-            # Loop over files in zip to check for filetypes to extract to separate folders
-            for name in zip_names:
-                if name.split(".")[-1] in files_to_folder:
-                    zip_ref.extractall(path=target_path / zip_ref.filename.split(".")[0])
-                    # new_path.unlink()
-                    break
-                else:
-                    zip_ref.extractall(target_path)
+            with zipfile.ZipFile(new_path) as zip_ref:
+                if not extract_course_zip(zip_ref, target_path, new_path.name):
+                    continue
             logging.debug(f"Successfully extracted {file} to {new_path}")
-            zip_ref.close()
             new_path.unlink()
 
-        # Remove unwanted zip and html files
-        # clean_up_files(target_path)
-        for html_file in target_path.glob("*.html*"):
-            if "Table of Contents" in html_file.name:
-                clean_up_files(target_path, extensions=[".html"])
+    # Remove unwanted html files, reading the target folder once after all files are in place
+    if files:
+        with os.scandir(target_path) as entries:
+            has_contents_page = any(".html" in entry.name and "Table of Contents" in entry.name for entry in entries)
+        if has_contents_page:
+            clean_up_files(target_path, extensions=[".html", ".html.gz"])
+
+
+def remove_time_from_name(file_name: str) -> str:
+    """
+    Removes the download time brightspace adds to file names, like "10 am" or "1030 pm"
+    :param file_name: File name to clean
+    :return: File name without the time
+    """
+    return re.sub(r'\d{1,2}(\d{1,2})?\s(am|pm)?', "", file_name, flags=re.IGNORECASE)
+
+
+def extract_course_zip(zip_ref: zipfile.ZipFile, target_path: pathlib.Path, zip_name: str) -> bool:
+    """
+    Extracts a downloaded zip file to target path, or to a folder named after the zip within target path if it has
+    notebooks, data or code files
+    :param zip_ref: Open zip file to extract
+    :param target_path: Folder to extract to
+    :param zip_name: File name of the zip
+    :return: True if extracted, False if the zip was skipped for having too many files
+    """
+    files_to_folder = ["ipynb", "csv", "txt", "py"]  # Filetypes to extract to separate folders
+    # Only count files so folder entries don't push a zip over the limit
+    infos = [info for info in zip_ref.infolist() if not info.is_dir()]
+    if len(infos) > 15:  # Don't extract zip files with too many items
+        return False
+    # Extract once, to a separate folder named after the zip if it has any of the files_to_folder types
+    zip_extensions = {info.filename.rsplit(".", 1)[-1] for info in infos}
+    if zip_extensions & set(files_to_folder):
+        extract_zip(zip_ref, target_path / zip_name.split(".")[0], infos)
+    else:
+        extract_zip(zip_ref, target_path, infos)
+    return True
+
 
-def save_html_page(file_name: str, html: str) -> None:
+def extract_zip(zip_ref: zipfile.ZipFile, folder: pathlib.Path,
+                infos: Optional[List[zipfile.ZipInfo]] = None) -> None:
     """
-    Saves a html page to given file name from HTML source
+    Extracts all files in a zip file to a folder. Files are extracted in parallel, each thread reading from its own
+    handle on the zip file and copying in 1 MiB chunks so memory use stays flat
+    :param zip_ref: Open zip file to extract
+    :param folder: Folder to extract files to
+    :param infos: Optional members to extract when the caller already has them, defaults to all members
+    :return: None
+    """
+    # Create all folders in one pass first so the threads only have to write files
+    files = []
+    for info in zip_ref.infolist() if infos is None else infos:
+        # Skip files that would end up outside of folder
+        if info.filename.startswith("/") or ".." in pathlib.PurePosixPath(info.filename).parts:
+            logging.warning(f"Skipping unsafe path {info.filename} in {zip_ref.filename}")
+            continue
+        out = pathlib.Path(folder) / info.filename
+        if info.is_dir():
+            create_base_folder(out)
+        else:
+            create_base_folder(out.parent)
+            files.append(info)
+
+    # ZipFile is not safe to read from several threads, so every thread opens the archive on its own
+    handles = threading.local()
+    opened = []
+
+    def extract_member(info: zipfile.ZipInfo, source: Optional[zipfile.ZipFile] = None) -> None:
+        if source is None:
+            if not hasattr(handles, "zip_ref"):
+                handles.zip_ref = zipfile.ZipFile(zip_ref.filename)
+                opened.append(handles.zip_ref)
+            source = handles.zip_ref
+        with source.open(info) as src, open(pathlib.Path(folder) / info.filename, "wb") as dst:
+            shutil.copyfileobj(src, dst, 1 << 20)
+
+    # Zip files read from memory have no file to open again per thread, so extract them one file at a time
+    if zip_ref.filename is None:
+        for info in files:
+            extract_member(info, zip_ref)
+        return
+
+    try:
+        with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+            list(executor.map(extract_member, files))
+    finally:
+        for handle in opened:
+            handle.close()
+
+
+def save_html_page(file_name: str, html: str, gzip_size: int = 64 * 1024) -> None:
+    """
+    Saves a html page to given file name from HTML source. Pages larger than gzip_size are gzipped and saved with
+    .gz added to the file name, smaller pages are saved as they are since compressing them gains little
     :param file_name: File name to save
     :param html: HTML code
+    :param gzip_size: Size in characters from which pages are gzipped
     :return: None
     """
-    with open(file_name, "w") as f:
-        f.write(html)
+    if len(html) >= gzip_size:
+        with gzip.open(f"{file_name}.gz", "wt", encoding="utf-8", compresslevel=6) as f:
+            f.write(html)
+    else:
+        with open(file_name, "w", encoding="utf-8", newline="") as f:
+            f.write(html)
 
 
 def clean_up_files(folder=save_folder, extensions=[".zip"]) -> None:
     """
-    Removes files with given provided extensions in provided folder
+    Removes files with given provided extensions in provided folder. Files are matched on the end of their name so
+    extensions with several parts like .html.gz work
     :param folder: Folder to clean up files in
     :param extensions: Extensions to look for
     :return:
     """
-    files = {p.resolve() for p in pathlib.Path(folder).glob("*") if p.suffix in extensions}
+    files = {p.resolve() for p in pathlib.Path(folder).glob("*") if p.name.endswith(tuple(extensions))}
     for file in files:
         file.unlink()
 
 
-def request_download(url: str) -> None:
+def request_download(session: requests.Session, url: str, folder: pathlib.Path,
+                     auth: Optional[Tuple[str, str]] = None, file_name: Optional[str] = None,
+                     extract_zips: bool = False) -> None:
     """
-    Downloads content from a url
+    Downloads content from a url, streaming it to disk in 1 MiB chunks. With extract_zips small zip files are read
+    into memory and extracted straight to folder instead of being saved and extracted later
+    :param session: Session to download with so connections are reused
     :param url: Url to download from
+    :param folder: Folder to save the downloaded file to
+    :param auth: Optional user name and password for basic auth
+    :param file_name: Optional name to save the file as, defaults to the last part of the url
+    :param extract_zips: Set when the caller extracts zips in folder with move_and_extract_files afterwards
     :return: None
     """
-    with requests.get(url) as r:
-        file_name = url.split("/")[-1]
+    with session.get(url, auth=auth, stream=True) as r:
+        file_name = file_name or url.split("/")[-1]
         r.raise_for_status()
-        with open(file_name, "wb") as f:
-            f.write(r.content)
+        r.raw.decode_content = True  # Decode gzip or deflate content encoding while streaming
+        content_length = int(r.headers.get("Content-Length", 0))
+        # Only buffer a few zips at a time, the others are streamed to disk so memory use stays bounded
+        if (extract_zips and file_name.endswith(".zip") and 0 < content_length < IN_MEMORY_ZIP_SIZE
+                and in_memory_zips.acquire(blocking=False)):
+            try:
+                buffer = io.BytesIO(r.content)
+                if zipfile.is_zipfile(buffer):
+                    with zipfile.ZipFile(buffer) as zip_ref:
+                        if extract_course_zip(zip_ref, pathlib.Path(folder), remove_time_from_name(file_name)):
+                            return
+                # Save zips that could not be extracted, move_and_extract_files handles them afterwards
+                with open(pathlib.Path(folder) / file_name, "wb") as f:
+                    f.write(buffer.getbuffer())
+                return
+            finally:
+                in_memory_zips.release()
+        with open(pathlib.Path(folder) / file_name, "wb") as f:
+            shutil.copyfileobj(r.raw, f, length=1 << 20)
 
 
 def dl_bootcamp_files(bc_url: str = bootcamp_url, bc_password: str = bootcamp_pass,
@@ -323,63 +705,96 @@ def dl_bootcamp_files(bc_url: str = bootcamp_url, bc_password: str = bootcamp_pa
         target_path = save_folder / "Data science & text mining"
 
 
-    # Construct url from user name, password and boocamp url
-    url = f"https://{bc_user_name}:{bc_password}@{bc_url.replace('https://', '')}"
+    # Send user name and password as basic auth instead of in the url
+    auth = (bc_user_name, bc_password)
 
-    # Request url and parse with BeautifulSoup
-    r = requests.get(url)
-    soup = BeautifulSoup(r.text, "html.parser")
-    # Find links on page and extract url
-    list_items = soup.find_all("li", class_="list-group")
-    items_in_tabs = []
-    for li in list_items:
-        parent_ids = [parent for parent in li.find_parents() if parent.get("id") in tabs]
-        if parent_ids:
-            items_in_tabs.append(li)
-        else:
-            continue
-    #parents = [item.find_parent().find_parent().get("id") in "nav-datasets-tab" for item in list_items]
-    #list_items = soup.find_all(True, {"id": ["nav-courses-tab", "nav-datasets-tab", "nav-assignments-tab"]})
-    #items_children = [item.find_all("li", class_="list-group") for item in list_items]
-    links = [item.find("a").get("href") for item in items_in_tabs if item.find("a") is not None]
+    # Request url and parse with lxml
+    r = SESSION.get(bc_url, auth=auth)
+    tree = lxml.html.fromstring(r.content)
+    # Find list items with the list-group class inside one of the tabs
+    tab_ids = " or ".join(f"@id='{tab}'" for tab in tabs)
+    items_in_tabs = tree.xpath(f"//li[contains(concat(' ', normalize-space(@class), ' '), ' list-group ')]"
+                               f"[ancestor::*[{tab_ids}]]")
+    # Extract url of the first link in each list item
+    links = []
+    for item in items_in_tabs:
+        anchors = item.xpath(".//a")
+        if anchors:
+            links.append(anchors[0].get("href"))
 
     # Loop over urls and extract those who are datasets or links to files on bootcamp page
     to_download = {}
     for link in links:
-        if "yotta" in link:  # Bootcamp files have yotta in link
-            to_download[link] = "yotta"
-        elif ".zip" in link:  # Datasets are stored as zip and on external links
-            to_download[link] = "dataset"
+        link_type = LINK_TYPES.match(link)
+        if link_type:
+            to_download[link] = link_type.lastgroup
 
-    # Loop over all urls and save to python_bootcamp folder
+    # Resolve all urls up front. Bootcamp urls are downloaded over https with user name and password
+    downloads = []
     for url, source in to_download.items():
-        # Check if url is bootcamp url to construct download url with user name and password
         if source == "yotta":
             url_no_method = url.split("//")[-1]
-            url = f"https://{bc_user_name}:{bc_password}@{url_no_method}"
-        request_download(url)
+            downloads.append((f"https://{url_no_method}", auth))
+        else:
+            downloads.append((url, None))
+    # Download all urls in parallel to the python_bootcamp folder, sharing the session's connection pool
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        list(executor.map(lambda download: request_download(SESSION, download[0], target_path, auth=download[1],
+                                                            extract_zips=True),
+                          downloads))
     # Extract zip files in bootcamp folder
     move_and_extract_files(target_path, source_folder=target_path)
 
 
+def download_course(course: Dict[str, str]) -> None:
+    """
+    Downloads content of a course with a driver from the driver pool and returns the driver to the pool when done
+    :param course: Dict with course "name" and "code"
+    :return: None
+    """
+    driver, download_dir = driver_pool.get()
+    course_code = course["code"]
+    course_name = course["name"]
+    course_url = f"{BASE_URL}{course_code}/home"
+    try:
+        logging.debug(f"Attempting to get content from {course_name}")
+        # Use the content API when possible and fall back to clicking through the content page
+        if not get_docs_from_api(course_code, course_name):
+            get_docs_from_course(driver, course_url, course_name, download_dir)
+        logging.debug(f"Finished getting content from {course_name}")
+    except Exception as e:
+        logging.debug(e)
+        # raise e
+    finally:
+        driver_pool.put((driver, download_dir))
+
+
 if __name__ == '__main__':
     courses = open_course_list()
     dl_bootcamp_files()
+    manifest.update(load_manifest())
 
-    log_in()
+    # Clean up once before starting, including download folders left over from an interrupted run
     clean_up_files(save_folder)
-
-    for course in courses:
-        clean_up_files()
-        course_code = course["code"]
-        course_name = course["name"]
-        course_url = f"{BASE_URL}{course_code}/home"
-        try:
-            logging.debug(f"Attempting to get content from {course_name}")
-            get_docs_from_course(course_url, course_name)
-            logging.debug(f"Finished getting content from {course_name}")
-        except Exception as e:
-            logging.debug(e)
-            # raise e
-    driver.quit()  # Explicitly close driver when finished
+    shutil.rmtree(download_root, ignore_errors=True)
+    # Start one driver per worker. Only the first logs in, the others reuse its session cookies
+    cookies = []
+    for worker in range(max(1, min(args.workers, len(courses)))):
+        worker_dir = download_root / str(worker)
+        worker_driver = make_driver(worker_dir, cookies)
+        if not cookies:
+            log_in(worker_driver)
+            cookies = get_session_cookies(worker_driver)
+        driver_pool.put((worker_driver, worker_dir))
+    # Share the log in with SESSION for the content API
+    for cookie in cookies:
+        SESSION.cookies.set(cookie["name"], cookie["value"], domain=cookie.get("domain"), path=cookie.get("path", "/"))
+
+    with ThreadPoolExecutor(max_workers=driver_pool.qsize()) as executor:
+        list(executor.map(download_course, courses))
+
+    while not driver_pool.empty():
+        driver_pool.get()[0].quit()  # Explicitly close drivers when finished
+    shutil.rmtree(download_root, ignore_errors=True)
     clean_up_files(save_folder)
+    SESSION.close()